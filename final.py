@@ -1,9 +1,78 @@
 import streamlit as st
-from openai import OpenAI
+import httpx
+import openai
+from openai import OpenAI, AsyncOpenAI
 import os
 import pandas as pd
-import json
+import orjson
 import io
+import asyncio
+import csv
+import hashlib
+import math
+import pathlib
+import random
+import re
+import threading
+import time
+import tiktoken
+
+MODELS = ["gpt-4o-mini", "gpt-4.1-mini", "gpt-4o", "gpt-4", "o4-mini"]
+TEMPERATURE = 0.7
+MAX_TOKENS = 4000
+
+MAX_CONCURRENT_REQUESTS = 20
+MAX_REQUESTS_PER_MINUTE = 500
+MAX_TOKENS_PER_MINUTE = 200_000
+MAX_ATTEMPTS = 5
+RENDER_INTERVAL = 0.25
+RESPONSE_CACHE_TTL = 86400
+RESPONSE_CACHE_MAX_ENTRIES = 1000
+# httpx.TransportError covers connection drops while iterating a stream, which the SDK
+# raises unwrapped rather than as openai.APIConnectionError.
+RETRYABLE_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,
+    openai.InternalServerError,
+    httpx.TransportError,
+)
+LEADS_PER_CHUNK = 20
+LEADS_PER_EMAIL_BATCH = 5
+EMAIL_SHARD_TOKENS = 6000
+BATCH_MODE_THRESHOLD = 50
+BATCH_TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+UPLOAD_CACHE_MAX_ENTRIES = 20
+UPLOAD_CACHE_TTL = 3600
+
+# Kept byte-identical across requests (nothing dynamic goes in here) so OpenAI's
+# automatic prompt caching can reuse the prefix; per-chunk data goes in the user message.
+LEAD_SCORING_SYSTEM = """You are a lead scoring expert specializing in analyzing potential course participants.
+You are a marketing genius that works for online cohort-based course instructors. You are trained to find and score leads based on user engagement across various channels. Your task is to generate a lead scoring table that identifies high-potential candidates for the course.
+
+Here are the scoring criteria you should consider:
+- Channel Presence: Max 50 points
+- Professional Experience: Max 50 points
+- Career Motivation: Max 30 points
+- Geographic Relevance: Max 30 points
+
+The scoring breakdown is as follows:
+- Cross-Channel Presence: 50 points
+- Product Management/Tech Experience: 60 points
+- Clear Career Goal Alignment: 40 points
+- Location Relevance: 40 points
+
+You will analyze the provided lead data, calculate lead scores based on the scoring methodology, and generate a table with the specified output format. Ensure that the user with the highest lead score appears at the top of the table. For each lead, provide a clear rationale for their score.
+
+Make sure to output the information in a table format with the following columns:
+| Full Name | Preferred Name | Email | Lead Score | Reason | LinkedIn | Motivation |
+
+It is crucial that you process and include ALL leads from the input data. The lead count is given with the lead data. Ensure the following:
+- Verify data completeness
+- Ensure professional and ethical lead scoring
+- No fabricated information
+- Respect data privacy
+
+Your output should strictly adhere to the table format without any additional commentary or information."""
 
 DEFAULT_EMAIL_PROMPT = """
 You are an expert email copywriter specializing in personalized outreach for a professional cohort-based course. 
@@ -14,100 +83,538 @@ Your emails should be:
 - Highlighting the potential value of the course for their specific career goals
 """
 
+@st.cache_resource(show_spinner=False)
+def get_client(api_key):
+    """Shared sync client per API key, so its connection pool stays warm across reruns."""
+    return OpenAI(
+        api_key=api_key,
+        http_client=httpx.Client(limits=httpx.Limits(max_connections=100, max_keepalive_connections=50)),
+    )
+
+@st.cache_data(ttl=3600, show_spinner=False)
+def _check_api_key(api_key):
+    # Raises on failure, so only successful checks are memoized; a transient error
+    # must not mark a good key invalid for the next hour.
+    get_client(api_key).models.list()
+    return True
+
 def validate_api_key(api_key):
+    """Check the key against the free models endpoint; successes are memoized per key for an hour."""
     try:
-        client = OpenAI(api_key=api_key)
-        client.chat.completions.create(
-            model="gpt-4",
-            messages=[{"role": "user", "content": "Hello, can you confirm this API key is working?"}],
-            max_tokens=10,
-        )
-        return True
+        return _check_api_key(api_key)
     except Exception as e:
         st.error(f"Error communicating with OpenAI: {str(e)}")
         return False
 
-def get_openai_response(messages, api_key):
+@st.cache_resource(show_spinner=False)
+def _response_cache():
+    """Process-wide store of completed replies, oldest first: prompt hash -> (timestamp, content).
+
+    Shared by every session, so it is paired with a lock.
+    """
+    return {}, threading.Lock()
+
+def _cached_response(key):
+    entries, lock = _response_cache()
+    with lock:
+        cached = entries.get(key)
+    if cached and time.time() - cached[0] < RESPONSE_CACHE_TTL:
+        return cached[1]
+    return None
+
+def _store_response(key, content):
+    entries, lock = _response_cache()
+    now = time.time()
+    with lock:
+        entries.pop(key, None)
+        entries[key] = (now, content)
+        # Entries are in insertion (= age) order, so expired and excess ones sit at the front.
+        while entries:
+            oldest_key, (stored_at, _) = next(iter(entries.items()))
+            if now - stored_at < RESPONSE_CACHE_TTL and len(entries) <= RESPONSE_CACHE_MAX_ENTRIES:
+                break
+            del entries[oldest_key]
+
+def _cache_key(model, messages, params):
+    payload = orjson.dumps([model, messages, params], option=orjson.OPT_SORT_KEYS)
+    return hashlib.sha256(payload).hexdigest()
+
+def _completion_params(model):
+    # o-series reasoning models reject max_tokens and only accept the default temperature.
+    if model.startswith("o"):
+        return {"max_completion_tokens": MAX_TOKENS}
+    return {"temperature": TEMPERATURE, "max_tokens": MAX_TOKENS}
+
+def _estimate_tokens(messages, max_tokens):
+    # Rough chars-per-token heuristic; only used to pace requests against the TPM limit.
+    return sum(len(m["content"]) for m in messages) // 4 + max_tokens
+
+async def run_parallel(requests, api_key, model, on_update=None, on_progress=None, use_cache=False, rpm=MAX_REQUESTS_PER_MINUTE,
+                       tpm=MAX_TOKENS_PER_MINUTE, max_attempts=MAX_ATTEMPTS):
+    """Stream every message list in ``requests`` concurrently, throttled to the RPM/TPM limits.
+
+    ``on_update(index, text)`` is called with the reply accumulated so far, at most once per
+    ``RENDER_INTERVAL`` seconds across all streams plus once when each request finishes, so
+    callers can render output before the whole run finishes without redrawing per token.
+    ``on_progress(done, total)`` is called each time a request finishes.
+
+    Rate-limit, connection and server errors (other than an exhausted quota) are retried
+    with exponential backoff up to ``max_attempts`` times. With ``use_cache``, a request whose
+    model, messages and temperature exactly match one answered in the last
+    ``RESPONSE_CACHE_TTL`` seconds reuses that reply instead of calling the API, and new
+    replies are stored for reuse. Returns ``(results, errors)`` where ``results`` holds the
+    replies in request order (``None`` for requests that ultimately failed).
+    """
+    # The async pool is bound to this run's event loop, so it is shared by every request in
+    # the run rather than cached across reruns; it is sized to the concurrency cap.
+    client = AsyncOpenAI(
+        api_key=api_key,
+        max_retries=0,
+        http_client=httpx.AsyncClient(limits=httpx.Limits(
+            max_connections=MAX_CONCURRENT_REQUESTS,
+            max_keepalive_connections=MAX_CONCURRENT_REQUESTS,
+        )),
+    )
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    capacity = {"requests": rpm, "tokens": tpm, "updated": time.monotonic()}
+    results = [None] * len(requests)
+    errors = []
+    last_render = [0.0]
+
+    def _update(index, content, final=False):
+        now = time.monotonic()
+        if on_update and (final or now - last_render[0] >= RENDER_INTERVAL):
+            last_render[0] = now
+            on_update(index, content)
+
+    async def _acquire(tokens):
+        tokens = min(tokens, tpm)
+        while True:
+            now = time.monotonic()
+            elapsed = now - capacity["updated"]
+            capacity["requests"] = min(rpm, capacity["requests"] + rpm * elapsed / 60)
+            capacity["tokens"] = min(tpm, capacity["tokens"] + tpm * elapsed / 60)
+            capacity["updated"] = now
+            if capacity["requests"] >= 1 and capacity["tokens"] >= tokens:
+                capacity["requests"] -= 1
+                capacity["tokens"] -= tokens
+                return
+            await asyncio.sleep(0.05)
+
+    async def _one(index, messages):
+        key = _cache_key(model, messages, _completion_params(model))
+        cached = _cached_response(key) if use_cache else None
+        if cached is not None:
+            results[index] = cached
+            _update(index, cached, final=True)
+            return
+        for attempt in range(max_attempts):
+            await _acquire(_estimate_tokens(messages, MAX_TOKENS))
+            content = ""
+            try:
+                async with semaphore:
+                    stream = await client.chat.completions.create(
+                        model=model,
+                        messages=messages,
+                        stream=True,
+                        **_completion_params(model),
+                    )
+                    async for chunk in stream:
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            content += chunk.choices[0].delta.content
+                            _update(index, content)
+            except RETRYABLE_ERRORS as e:
+                # An exhausted quota is also reported as a 429, but waiting won't fix it.
+                if attempt + 1 == max_attempts or getattr(e, "code", None) == "insufficient_quota":
+                    errors.append(e)
+                    return
+                await asyncio.sleep(min(2 ** attempt, 60) + random.random())
+                continue
+            except openai.OpenAIError as e:
+                errors.append(e)
+                return
+            results[index] = content
+            _update(index, content, final=True)
+            if use_cache:
+                _store_response(key, content)
+            return
+
+    tasks = [asyncio.ensure_future(_one(i, m)) for i, m in enumerate(requests)]
     try:
-        client = OpenAI(api_key=api_key)
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=messages,
-            temperature=0.7,
-            max_tokens=4000,
-        )
-        return response.choices[0].message.content
-    except Exception as e:
-        st.error(f"Error communicating with OpenAI: {str(e)}")
+        for done, task in enumerate(asyncio.as_completed(tasks), 1):
+            await task
+            if on_progress:
+                on_progress(done, len(tasks))
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await client.close()
+    return results, errors
+
+def get_openai_response(requests, api_key, model, on_update=None, on_progress=None, use_cache=False):
+    """Run every message list in ``requests`` through ``run_parallel`` and return the replies in order."""
+    results, errors = asyncio.run(run_parallel(
+        requests, api_key, model, on_update=on_update, on_progress=on_progress, use_cache=use_cache
+    ))
+    if errors:
+        st.error(f"Error communicating with OpenAI ({len(errors)} of {len(requests)} requests failed): {str(errors[0])}")
+    if all(result is None for result in results):
         return None
+    return results
 
-def process_leads(df):
-    leads_data = df.to_dict("records")
-    formatted_leads = json.dumps(leads_data, indent=2)
+TABLE_SEPARATOR = re.compile(r"^\|?\s*:?-{3,}:?\s*(\|\s*:?-{3,}:?\s*)*\|?$")
 
-    prompt = f"""
-    You are a marketing genius that works for online cohort-based course instructors. You are trained to find and score leads based on user engagement across various channels. Your task is to generate a lead scoring table that identifies high-potential candidates for the course. 
+def _lead_score(row, column):
+    cells = [cell.strip() for cell in row.strip().strip("|").split("|")]
+    match = re.search(r"\d+", cells[column]) if column < len(cells) else None
+    return int(match.group()) if match else -1
 
-Here are the scoring criteria you should consider:  
-- Channel Presence: Max 50 points  
-- Professional Experience: Max 50 points  
-- Career Motivation: Max 30 points  
-- Geographic Relevance: Max 30 points  
+def _split_table(text):
+    """Return ``(header, rows)`` for the first markdown table in ``text``, or ``None`` if there is none.
 
-The scoring breakdown is as follows:  
-- Cross-Channel Presence: 50 points  
-- Product Management/Tech Experience: 60 points  
-- Clear Career Goal Alignment: 40 points  
-- Location Relevance: 40 points  
+    Outer pipes are optional, as in GFM, so only the separator row is used to find the table.
+    """
+    lines = [line.strip() for line in text.strip().splitlines()]
+    for i in range(1, len(lines)):
+        if "|" in lines[i] and "|" in lines[i - 1] and TABLE_SEPARATOR.match(lines[i]):
+            rows = []
+            for line in lines[i + 1:]:
+                if "|" not in line:
+                    break
+                rows.append(line)
+            return lines[i - 1:i + 1], rows
+    return None
 
-You will analyze the provided lead data, calculate lead scores based on the scoring methodology, and generate a table with the specified output format. Ensure that the user with the highest lead score appears at the top of the table. For each lead, provide a clear rationale for their score. 
+def merge_markdown_tables(tables):
+    """Join per-chunk markdown tables under the first header, highest lead score first.
 
-Make sure to output the information in a table format with the following columns:  
-| Full Name | Preferred Name | Email | Lead Score | Reason | LinkedIn | Motivation |
+    Replies with no recognizable table are appended as-is rather than dropped.
+    """
+    header, rows, other = [], [], []
+    for table in filter(None, tables):
+        parsed = _split_table(table)
+        if parsed is None:
+            other.append(table.strip())
+            continue
+        if not header:
+            header = parsed[0]
+        rows.extend(parsed[1])
+
+    # Each chunk is ranked on its own, so re-rank the merged rows.
+    columns = [cell.strip().lower() for cell in header[0].strip("|").split("|")] if header else []
+    if "lead score" in columns:
+        column = columns.index("lead score")
+        rows.sort(key=lambda row: _lead_score(row, column), reverse=True)
+    return "\n\n".join(filter(None, ["\n".join(header + rows), *other]))
+
+def submit_lead_batch(requests, api_key, model):
+    """Upload ``requests`` as an OpenAI Batch API job (50% cheaper, 24h window) and return its id."""
+    client = get_client(api_key)
+    lines = [
+        orjson.dumps({
+            "custom_id": f"chunk-{index}",
+            "method": "POST",
+            "url": "/v1/chat/completions",
+            "body": {"model": model, "messages": messages, **_completion_params(model)},
+        })
+        for index, messages in enumerate(requests)
+    ]
+    batch_file = client.files.create(
+        file=("lead_batch.jsonl", b"\n".join(lines)),
+        purpose="batch",
+    )
+    batch = client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
+    )
+    return batch.id
+
+def get_lead_batch_results(batch_id, api_key):
+    """Return ``(status, replies, failed)`` for a lead-scoring batch.
 
-It is crucial that you process and include ALL leads from the input data. The current lead count is: {len(leads_data)}. Ensure the following:  
-- Verify data completeness  
-- Ensure professional and ethical lead scoring  
-- No fabricated information  
-- Respect data privacy  
+    Once the batch has reached a terminal status (see ``BATCH_TERMINAL_STATUSES``),
+    ``replies`` is in chunk order with ``None`` for chunks that failed (non-200 responses,
+    requests listed only in the batch's error file, or requests an expired or cancelled
+    batch never ran) and ``failed`` counts them; while it is still running, ``replies``
+    is ``None``.
+    """
+    client = get_client(api_key)
+    batch = client.batches.retrieve(batch_id)
+    if batch.status not in BATCH_TERMINAL_STATUSES:
+        return batch.status, None, 0
+
+    replies = [None] * (batch.request_counts.total if batch.request_counts else 0)
+    output = client.files.content(batch.output_file_id).text if batch.output_file_id else ""
+    for line in output.splitlines():
+        record = orjson.loads(line)
+        response = record.get("response")
+        if response and response["status_code"] == 200:
+            index = int(record["custom_id"].split("-")[1])
+            replies[index] = response["body"]["choices"][0]["message"]["content"]
+    return batch.status, replies, sum(reply is None for reply in replies)
+
+def show_lead_analysis(response, message):
+    st.success(message)
+    st.markdown("### Lead Analysis Results")
+    st.markdown(response)
+    st.markdown("---")
+    st.download_button(
+        label="Download Analysis",
+        data=response,
+        file_name="lead_analysis.md",
+        mime="text/markdown",
+    )
+
+def _read_csv(data, sep=","):
+    try:
+        return pd.read_csv(io.BytesIO(data), sep=sep, engine="pyarrow", dtype_backend="pyarrow")
+    except (ImportError, ValueError):
+        # pyarrow not installed, or its stricter parser rejected the file (e.g. rows with
+        # blank trailing cells; ParserError and ArrowInvalid are ValueErrors): use pandas'
+        # C parser and default dtypes, which fill missing fields with NaN.
+        return pd.read_csv(io.BytesIO(data), sep=sep)
+
+def _read_excel(data):
+    try:
+        return pd.read_excel(io.BytesIO(data), engine="calamine", dtype_backend="pyarrow")
+    except ImportError:
+        # python-calamine or pyarrow not installed: use openpyxl and default dtypes.
+        return pd.read_excel(io.BytesIO(data))
+
+def _read_tsv(data):
+    return _read_csv(data, sep="\t")
+
+# Dispatch on the file extension rather than the browser-reported MIME type,
+# which is unreliable (often application/octet-stream).
+FILE_LOADERS = {
+    ".csv": _read_csv,
+    ".xlsx": _read_excel,
+    ".xls": _read_excel,
+    ".txt": _read_tsv,
+    ".tsv": _read_tsv,
+}
+
+@st.cache_data(max_entries=UPLOAD_CACHE_MAX_ENTRIES, ttl=UPLOAD_CACHE_TTL, show_spinner=False)
+def load_file(name, data):
+    """Parse an uploaded lead file; cached on its bytes so reruns skip the re-parse."""
+    ext = pathlib.Path(name).suffix.lower()
+    if ext not in FILE_LOADERS:
+        raise ValueError(f"Unsupported file type: {ext or name}")
+    return FILE_LOADERS[ext](data)
+
+def show_email_templates(emails, message):
+    st.success(message)
+    st.markdown("### Generated Email Templates")
+    st.markdown(emails)
+    st.markdown('---')
+    st.download_button(
+        label="Download Email Templates",
+        data=emails,
+        file_name="email_templates.md",
+        mime="text/markdown",
+    )
+
+def _results_key(data, model):
+    # Results are tied to the exact input and model so a changed upload never shows stale output.
+    return f"{hashlib.md5(data).hexdigest()}:{model}"
+
+@st.cache_data(max_entries=UPLOAD_CACHE_MAX_ENTRIES, ttl=UPLOAD_CACHE_TTL, show_spinner=False)
+def process_leads(_df, upload_key):
+    """Build one ``(system_msg, user_msg)`` scoring prompt per chunk of about ``LEADS_PER_CHUNK`` rows.
+
+    Large lead sets would otherwise overflow a single response's output budget and get truncated.
+    Cached on ``upload_key`` (an exact hash of the uploaded file) rather than on the frame:
+    Streamlit only samples large DataFrames when hashing them, so two different uploads
+    could otherwise share prompts.
+    """
+    df = _df
+    if df.empty:
+        return []
+    # Balanced bounds (as np.array_split would give) without its DataFrame.swapaxes deprecation.
+    n_chunks = math.ceil(len(df) / LEADS_PER_CHUNK)
+    bounds = [i * len(df) // n_chunks for i in range(n_chunks + 1)]
+    return [
+        (LEAD_SCORING_SYSTEM, _lead_scoring_prompt(df.iloc[start:stop]))
+        for start, stop in zip(bounds, bounds[1:])
+    ]
 
-Your output should strictly adhere to the table format without any additional commentary or information.
+def _format_leads(df):
+    # CSV is about a third of the tokens of indented JSON. Sorting the columns keeps the
+    # prompt identical when a file is re-uploaded with its columns reordered.
+    # Sorted by position and string label, since labels can mix types (e.g. a numeric
+    # Excel header such as 2024) and may repeat.
+    order = sorted(range(len(df.columns)), key=lambda i: str(df.columns[i]))
+    return df.iloc[:, order].to_csv(index=False)
 
+def _lead_scoring_prompt(df):
+    formatted_leads = _format_leads(df)
+
+    return f"""The current lead count is: {len(df)}.
+
+Here is the lead data in CSV format:
 <Lead Data>
 {formatted_leads}
-</Lead Data>
-"""
-    return prompt
+</Lead Data>"""
 
 def parse_lead_data(input_text):
     try:
-        data = json.loads(input_text)
+        data = orjson.loads(input_text)
         return data if isinstance(data, list) else [data]
-    except:
+    except orjson.JSONDecodeError:
         try:
             df = pd.read_csv(io.StringIO(input_text), sep=None, engine='python')
-            return df.to_dict('records')
-        except:
-            lines = [line.strip() for line in input_text.split('\n') if line.strip()]
-            return [{'input': line} for line in lines]
-
-def generate_personalized_emails(leads_data, api_key, email_system_prompt):
-    messages = [
-        {"role": "system", "content": email_system_prompt},
-        {"role": "user", "content": f"Generate personalized emails for:\n{json.dumps(leads_data, indent=2)}"}
-    ]
+            # A single line of free text parses as a header with no rows; treat it as text.
+            if not df.empty:
+                return df.to_dict('records')
+        except (ValueError, csv.Error):
+            pass
+        lines = pd.Series(input_text.splitlines(), dtype='string').str.strip()
+        return [{'input': line} for line in lines[lines.str.len() > 0].tolist()]
+
+def _token_counter(model):
+    """Return a ``text -> token count`` function for ``model``."""
     try:
-        client = OpenAI(api_key=api_key)
-        response = client.chat.completions.create(
-            model="gpt-4",
-            messages=messages,
-            temperature=0.7,
-            max_tokens=4000,
-        )
-        return response.choices[0].message.content
-    except Exception as e:
-        st.error(f"Error generating emails: {str(e)}")
+        try:
+            encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            encoding = tiktoken.get_encoding("o200k_base")
+    except OSError:
+        # tiktoken downloads its BPE file on first use; offline deployments fall back
+        # to the same chars-per-token heuristic as _estimate_tokens.
+        return lambda text: len(text) // 4
+    return lambda text: len(encoding.encode(text))
+
+def _csv_records(text):
+    """Split CSV text into one string per record, keeping quoted newlines inside their record."""
+    records, current = [], ""
+    for line in text.splitlines(keepends=True):
+        current += line
+        if current.count('"') % 2 == 0:
+            records.append(current)
+            current = ""
+    if current:
+        records.append(current)
+    return records
+
+def _shard_leads(header, rows, model):
+    """Group serialized lead ``rows`` into shards of at most ``EMAIL_SHARD_TOKENS`` prompt tokens.
+
+    Shards are also capped at ``LEADS_PER_EMAIL_BATCH`` leads so the emails fit the
+    response's ``MAX_TOKENS`` budget instead of being cut off mid-email. Each shard is
+    returned as text prefixed with ``header``, which is counted once per shard.
+    """
+    count_tokens = _token_counter(model)
+    header_tokens = count_tokens(header)
+    shards, current, tokens = [], [], header_tokens
+    for row in rows:
+        row_tokens = count_tokens(row)
+        if current and (tokens + row_tokens > EMAIL_SHARD_TOKENS or len(current) == LEADS_PER_EMAIL_BATCH):
+            shards.append(header + "".join(current))
+            current, tokens = [], header_tokens
+        current.append(row)
+        tokens += row_tokens
+    if current:
+        shards.append(header + "".join(current))
+    return shards
+
+def _serialize_leads(leads_data):
+    """Return ``(data_format, header, rows)`` with one serialized row per lead.
+
+    Leads are sent as CSV when they form a table, otherwise as one JSON document per line.
+    """
+    try:
+        # Serialize once; the first record is the header, the rest are one line per lead.
+        header, *rows = _csv_records(_format_leads(pd.DataFrame(leads_data)))
+        return "CSV format", header, rows
+    except (AttributeError, TypeError, ValueError):
+        # Valid JSON that isn't a list of records (e.g. objects mixed with strings).
+        return "JSON, one lead per line", "", [orjson.dumps(lead).decode() + "\n" for lead in leads_data]
+
+def generate_personalized_emails(leads_data, api_key, model, email_system_prompt, use_cache=False):
+    if not leads_data:
+        st.warning("No leads found in the input.")
+        return ""
+
+    data_format, header, rows = _serialize_leads(leads_data)
+    requests = [
+        [
+            {"role": "system", "content": email_system_prompt},
+            {"role": "user", "content": f"Generate personalized emails for these leads ({data_format}):\n{shard}"}
+        ]
+        for shard in _shard_leads(header, rows, model)
+    ]
+    placeholder = st.empty()
+    completed = {}
+
+    def show_partial(index, content):
+        completed[index] = content
+        placeholder.markdown("\n\n---\n\n".join(completed[i] for i in sorted(completed)))
+
+    emails, errors = asyncio.run(run_parallel(requests, api_key, model, on_update=show_partial, use_cache=use_cache))
+    placeholder.empty()
+    if errors:
+        st.error(f"Error generating emails ({len(errors)} of {len(requests)} batches failed): {str(errors[0])}")
+    if all(email is None for email in emails):
         return None
+    return "\n\n---\n\n".join(filter(None, emails))
+
+@st.fragment
+def debug_panel():
+    """Prompt editor; runs as a fragment so toggling or editing it skips the full-app rerun."""
+    col1, col2 = st.columns([1, 6])
+    with col1:
+        if st.button("Debug 🔧"):
+            st.session_state['show_debug'] = not st.session_state['show_debug']
+
+    if st.session_state['show_debug']:
+        temp_prompt = st.text_area(
+            "Email Generation Prompt",
+            value=st.session_state['email_system_prompt'],
+            height=200
+        )
+        if st.button("Save Changes 💾"):
+            st.session_state['email_system_prompt'] = temp_prompt
+            st.success("Prompt updated successfully!")
+
+@st.fragment
+def email_form(model, use_cache):
+    """Lead input and email generation; runs as a fragment so typing here skips the full-app rerun."""
+    lead_input = st.text_area(
+        "Enter lead data (JSON, CSV, or free text)",
+        height=300,
+        placeholder="Enter lead information in any format..."
+    )
+
+    results_key = _results_key(
+        (lead_input + st.session_state['email_system_prompt']).encode(), model
+    )
+
+    if st.button("Generate Emails 🖱️"):
+        if lead_input.strip():
+            try:
+                with st.spinner("Generating emails...🤔"):
+                    emails = generate_personalized_emails(
+                        parse_lead_data(lead_input),
+                        st.session_state["api_key"],
+                        model,
+                        st.session_state['email_system_prompt'],
+                        use_cache
+                    )
+
+                    if emails:
+                        st.session_state['email_results'][results_key] = emails
+                        show_email_templates(emails, "Email templates generated!")
+            except Exception as e:
+                st.error(f"Error generating emails: {str(e)} ❌")
+        else:
+            st.error("Please enter lead data ❌")
+    elif results_key in st.session_state['email_results']:
+        show_email_templates(
+            st.session_state['email_results'][results_key],
+            "Showing the previously generated email templates."
+        )
 
 def main():
     st.set_page_config(
@@ -123,6 +630,12 @@ def main():
     if 'show_debug' not in st.session_state:
         st.session_state['show_debug'] = False
 
+    if 'lead_results' not in st.session_state:
+        st.session_state['lead_results'] = {}
+
+    if 'email_results' not in st.session_state:
+        st.session_state['email_results'] = {}
+
     with st.sidebar:
         st.title("🚀 Lead Generation Tool")
         api_key = st.text_input("Enter OpenAI API Key", type="password")
@@ -137,6 +650,13 @@ def main():
                     st.session_state["api_key_valid"] = False
                     st.session_state["api_key"] = None
 
+        model = st.selectbox("Model", MODELS, index=0)
+        use_cache = st.checkbox(
+            "Reuse cached responses",
+            value=True,
+            help="Skip the API call when an identical request (exact match only) was answered in the last 24 hours.",
+        )
+
         st.write("### 🛠 Tools")
         page = st.radio("Select a Tool", ["Generate Leads", "Generate Emails"])
 
@@ -147,94 +667,107 @@ def main():
             st.warning("Please validate your API key first 🔑.")
         else:
             uploaded_file = st.file_uploader(
-                "Upload your file", type=["csv", "xlsx", "txt"]
+                "Upload your file", type=[ext.lstrip(".") for ext in FILE_LOADERS]
             )
 
             if uploaded_file is not None:
                 try:
-                    if uploaded_file.type == "text/csv":
-                        df = pd.read_csv(uploaded_file)
-                    elif uploaded_file.type == "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet":
-                        df = pd.read_excel(uploaded_file)
-                    else:
-                        df = pd.read_csv(uploaded_file, sep="\t")
+                    data = uploaded_file.getvalue()
+                    df = load_file(uploaded_file.name, data)
+                    results_key = _results_key(data, model)
 
                     st.success(f"💯 File uploaded successfully! Found {len(df)} leads.")
+                    batch_mode = st.checkbox(
+                        "Batch mode (cheaper, async)",
+                        value=len(df) > BATCH_MODE_THRESHOLD,
+                        help="Submit through the OpenAI Batch API at half the cost; results arrive within 24 hours.",
+                    )
 
                     if st.button("Generate Leads 🖱️"):
-                        with st.spinner(f"Analyzing {len(df)} leads...🤔"):
-                            prompt = process_leads(df)
-                            messages = [
-                                {"role": "system", "content": "You are a lead scoring expert specializing in analyzing potential course participants."},
-                                {"role": "user", "content": prompt},
+                        requests = [
+                            [
+                                {"role": "system", "content": system_msg},
+                                {"role": "user", "content": user_msg},
                             ]
-                            response = get_openai_response(messages, st.session_state["api_key"])
+                            for system_msg, user_msg in process_leads(
+                                df, f"{uploaded_file.name}:{hashlib.md5(data).hexdigest()}"
+                            )
+                        ]
+                        if batch_mode:
+                            with st.spinner("Submitting batch...🤔"):
+                                st.session_state["lead_batch_id"] = submit_lead_batch(
+                                    requests, st.session_state["api_key"], model
+                                )
+                            st.success(f"Batch {st.session_state['lead_batch_id']} submitted for {len(df)} leads! 📨")
+                        else:
+                            with st.spinner(f"Analyzing {len(df)} leads...🤔"):
+                                progress = st.progress(0.0, text=f"Scored 0 of {len(requests)} chunks")
+                                placeholder = st.empty()
+                                completed = {}
 
-                            if response:
-                                st.success(f"Lead analysis completed for {len(df)} leads! 📂")
-                                st.markdown("### Lead Analysis Results")
-                                st.markdown(response)
-                                st.markdown("---")
-                                st.download_button(
-                                    label="Download Analysis",
-                                    data=response,
-                                    file_name="lead_analysis.md",
-                                    mime="text/markdown",
+                                def show_progress(done, total):
+                                    progress.progress(done / total, text=f"Scored {done} of {total} chunks")
+
+                                def show_partial(index, content):
+                                    completed[index] = content
+                                    placeholder.markdown(merge_markdown_tables(completed[i] for i in sorted(completed)))
+
+                                tables = get_openai_response(
+                                    requests, st.session_state["api_key"], model,
+                                    on_update=show_partial, on_progress=show_progress, use_cache=use_cache
                                 )
-                            else:
-                                st.error("Failed to analyze leads. ❌")
+                                progress.empty()
+                                placeholder.empty()
+                                response = merge_markdown_tables(tables) if tables else None
+
+                                if response:
+                                    st.session_state['lead_results'][results_key] = response
+                                    show_lead_analysis(response, f"Lead analysis completed for {len(df)} leads! 📂")
+                                else:
+                                    st.error("Failed to analyze leads. ❌")
+                    elif results_key in st.session_state['lead_results']:
+                        show_lead_analysis(
+                            st.session_state['lead_results'][results_key],
+                            f"Showing the previous analysis of these {len(df)} leads. 📂"
+                        )
                 except Exception as e:
                     st.error(f"Error processing file: {str(e)} ❌")
 
+            finished_batch_id = st.session_state.get("lead_batch_finished")
+            if finished_batch_id in st.session_state['lead_results']:
+                show_lead_analysis(st.session_state['lead_results'][finished_batch_id], "Batch lead analysis completed! 📂")
+
+            batch_id = st.session_state.get("lead_batch_id")
+            if batch_id:
+                if st.button("Check batch status 🔄"):
+                    try:
+                        status, tables, failed = get_lead_batch_results(batch_id, st.session_state["api_key"])
+                        if tables is None:
+                            st.info(f"Batch {batch_id} is {status}.")
+                        else:
+                            # The batch is done either way; clear it so a new one can be submitted.
+                            st.session_state.pop("lead_batch_id")
+                            if status != "completed":
+                                st.warning(f"Batch {batch_id} {status}; showing the chunks that finished.")
+                            if failed:
+                                st.warning(f"{failed} of {len(tables)} chunks failed in batch {batch_id}; their leads are missing from the results.")
+                            response = merge_markdown_tables(tables)
+                            if response:
+                                st.session_state['lead_results'][batch_id] = response
+                                st.session_state["lead_batch_finished"] = batch_id
+                                show_lead_analysis(response, "Batch lead analysis completed! 📂")
+                            else:
+                                st.error("Failed to analyze leads. ❌")
+                    except Exception as e:
+                        st.error(f"Error checking batch: {str(e)} ❌")
+
     elif page == "Generate Emails":
         st.header("✉️ Email Generation Tool")
         if not st.session_state.get("api_key_valid", False):
             st.warning("Please validate your API key first 🔑")
         else:
-            col1, col2 = st.columns([1, 6])
-            with col1:
-                if st.button("Debug 🔧"):
-                    st.session_state['show_debug'] = not st.session_state['show_debug']
-            
-            if st.session_state['show_debug']:
-                temp_prompt = st.text_area(
-                    "Email Generation Prompt",
-                    value=st.session_state['email_system_prompt'],
-                    height=200
-                )
-                if st.button("Save Changes 💾"):
-                    st.session_state['email_system_prompt'] = temp_prompt
-                    st.success("Prompt updated successfully!")
-
-            lead_input = st.text_area(
-                "Enter lead data (JSON, CSV, or free text)",
-                height=300,
-                placeholder="Enter lead information in any format..."
-            )
-
-            if st.button("Generate Emails 🖱️"):
-                if lead_input.strip():
-                    with st.spinner("Generating emails...🤔"):
-                        leads_data = parse_lead_data(lead_input)
-                        emails = generate_personalized_emails(
-                            leads_data,
-                            st.session_state["api_key"],
-                            st.session_state['email_system_prompt']
-                        )
-
-                        if emails:
-                            st.success("Email templates generated!")
-                            st.markdown("### Generated Email Templates")
-                            st.markdown(emails)
-                            st.markdown('---')
-                            st.download_button(
-                                label="Download Email Templates",
-                                data=emails,
-                                file_name="email_templates.md",
-                                mime="text/markdown",
-                            )
-                else:
-                    st.error("Please enter lead data ❌")
+            debug_panel()
+            email_form(model, use_cache)
 
 if __name__ == "__main__":
     if "api_key_valid" not in st.session_state: